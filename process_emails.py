@@ -1,12 +1,20 @@
 import os
 import json
+import asyncio
 import base64
+import codecs
 import csv
 import re
 import io
-from datetime import datetime, timezone
-from typing import Optional, Dict, List, Tuple
+import threading
+from collections import deque
+from pathlib import Path
+from datetime import date, datetime, timezone
+from typing import Optional, Dict, Iterable, Iterator, List, Set, Tuple
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -15,20 +23,91 @@ from googleapiclient.errors import HttpError
 
 from notion_client import Client
 
+# Partial response masks: only request the message fields this script reads,
+# following nested MIME parts four levels deep
+_GMAIL_PART_FIELDS = 'mimeType,filename,body(data,attachmentId)'
+GMAIL_MESSAGE_FIELDS = (
+    'id,payload(mimeType,body(data,attachmentId),'
+    f'parts({_GMAIL_PART_FIELDS},parts({_GMAIL_PART_FIELDS},'
+    f'parts({_GMAIL_PART_FIELDS},parts({_GMAIL_PART_FIELDS})))))'
+)
+GMAIL_SEARCH_FIELDS = 'messages/id'
+
+# Link extraction patterns
+_HREF_RE = re.compile(r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>', re.IGNORECASE)
+_HTML_URL_RE = re.compile(r'https?://[^\s<>"\']+(?:\.csv|s3\.amazonaws\.com[^\s<>"\']*)', re.IGNORECASE)
+_CSV_TEXT_RE = re.compile(r'https?://[^\s<>"]+\.csv[^\s<>"]*', re.IGNORECASE)
+_S3_TEXT_RE = re.compile(r'https?://[^\s<>"]*s3\.amazonaws\.com[^\s<>"]+', re.IGNORECASE)
+_ANY_URL_RE = re.compile(r'https?://[^\s<>"]+')
+
+# Order IDs are plain integers or decimals; anything else is a total/summary row
+_ORDER_ID_RE = re.compile(r'\A\d+(?:\.\d+)?\Z')
+
+# Date formats tried in order when parsing CSV dates
+_DATE_FORMATS = (
+    '%Y-%m-%d',
+    '%m/%d/%Y',
+    '%d/%m/%Y',
+    '%Y-%m-%d %H:%M:%S',
+    '%m/%d/%Y %H:%M:%S',
+    '%d-%m-%Y',
+    '%Y/%m/%d',
+)
+# Fast path covering the numeric shapes of _DATE_FORMATS in a single match
+_DATE_RE = re.compile(
+    r'(?:(?P<y1>\d{4})(?P<sep1>[-/])(?P<m1>\d{1,2})(?P=sep1)(?P<d1>\d{1,2})'
+    r'|(?P<a>\d{1,2})(?P<sep2>[-/])(?P<b>\d{1,2})(?P=sep2)(?P<y2>\d{4}))'
+    r'(?: (?P<hour>\d{1,2}):(?P<minute>\d{1,2}):(?P<second>\d{1,2}))?'
+)
+_DATE_NO_YEAR_FORMATS = (
+    '%m/%d',
+    '%d/%m',
+    '%b %d',
+    '%B %d',
+)
+
+# Read size when streaming CSV downloads
+CSV_CHUNK_SIZE = 64 * 1024
+
+NOTION_API_URL = 'https://api.notion.com/v1'
+NOTION_API_VERSION = '2022-06-28'
+
+# Maximum Notion requests in flight at once
+NOTION_CONCURRENCY = 3
+# Notion allows an average of 3 requests per second per integration,
+# so request starts are spaced at least this many seconds apart
+NOTION_REQUEST_INTERVAL = 1 / 3
+NOTION_MAX_RETRIES = 5
+
 
 class EmailProcessor:
     def __init__(self):
-        self.gmail_service = self._init_gmail()
-        self.notion = Client(auth=os.environ['NOTION_API_KEY'])
+        # Quiet mode for production (minimal logging for public repos)
+        self.quiet_mode = os.environ.get('QUIET_MODE', 'true').lower() == 'true'
+        
+        # Gmail services are built per thread since httplib2 is not thread-safe
+        self._gmail_creds = self._init_gmail()
+        self._gmail_local = threading.local()
+        self.notion = Client(auth=os.environ['NOTION_API_KEY'], client=httpx.Client(http2=True))
         self.database_id = os.environ['NOTION_DATABASE_ID']
         self.alert_email = os.environ.get('ALERT_EMAIL')
         
-        # Quiet mode for production (minimal logging for public repos)
-        self.quiet_mode = os.environ.get('QUIET_MODE', 'true').lower() == 'true'
+        # Notion property names from environment
+        self.notion_props = {
+            'source': os.environ.get('NOTION_SOURCE_PROPERTY', 'Source'),
+            'amount': os.environ.get('NOTION_AMOUNT_PROPERTY', 'Order Amount'),
+            'id': os.environ.get('NOTION_ID_PROPERTY', 'Order ID'),
+            'date': os.environ.get('NOTION_DATE_PROPERTY', 'Order Date'),
+            'check': os.environ.get('NOTION_CHECKBOX_PROPERTY', 'Sum-er'),
+        }
         
         # Email search queries from environment
         self.email1_query = os.environ.get('EMAIL1_SEARCH_QUERY')
         self.email2_query = os.environ.get('EMAIL2_SEARCH_QUERY')
+        
+        # Pooled keep-alive session for CSV downloads
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
     
     def log(self, message: str, level: str = 'info'):
         """Log message with minimal detail for public logs"""
@@ -39,8 +118,8 @@ class EmailProcessor:
         else:
             print(message)
     
-    def _init_gmail(self):
-        """Initialize Gmail API service"""
+    def _init_gmail(self) -> Credentials:
+        """Initialize Gmail API credentials"""
         # Get access token if provided, otherwise will use refresh token
         access_token = os.environ.get('GMAIL_ACCESS_TOKEN', '')
         
@@ -60,7 +139,12 @@ class EmailProcessor:
         if access_token:
             token_data['token'] = access_token
         
-        creds = Credentials.from_authorized_user_info(token_data)
+        # Reuse a cached access token from a previous run until it expires
+        cache_path = Path(os.environ.get('GMAIL_TOKEN_CACHE', '.gmail_token.json'))
+        creds = self._load_cached_gmail_creds(cache_path, token_data)
+        
+        if creds is None:
+            creds = Credentials.from_authorized_user_info(token_data)
         
         # Refresh token to get valid access token
         if not creds.valid:
@@ -69,8 +153,50 @@ class EmailProcessor:
             except Exception as e:
                 self.log(f"Authentication error: {e}", 'error')
                 raise
+            
+            # Create the cache owner-only from the start since it holds live tokens
+            try:
+                fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as cache_file:
+                    # Tighten an existing cache file created with a looser mode
+                    os.fchmod(cache_file.fileno(), 0o600)
+                    cache_file.write(creds.to_json())
+            except OSError as e:
+                self.log(f"Token cache write error", 'error')
+        
+        return creds
+    
+    @property
+    def gmail_service(self):
+        """Gmail API service for the current thread"""
+        service = getattr(self._gmail_local, 'service', None)
+        if service is None:
+            service = self._gmail_local.service = build('gmail', 'v1', credentials=self._gmail_creds)
+        return service
+    
+    def _load_cached_gmail_creds(self, cache_path: Path, token_data: Dict) -> Optional[Credentials]:
+        """Load the cached Gmail access token if it belongs to the configured client"""
+        try:
+            cached = json.loads(cache_path.read_text())
+        except (OSError, ValueError):
+            return None
+        
+        # Ignore the cache when the refresh token or client has been rotated
+        if (not cached.get('token')
+                or cached.get('refresh_token') != token_data['refresh_token']
+                or cached.get('client_id') != token_data['client_id']):
+            return None
         
-        return build('gmail', 'v1', credentials=creds)
+        # Client secret and token URI always come from the environment;
+        # only the access token and its expiry are reused from the cache
+        try:
+            return Credentials.from_authorized_user_info({
+                **token_data,
+                'token': cached['token'],
+                'expiry': cached.get('expiry'),
+            })
+        except ValueError:
+            return None
     
     def search_email(self, query: str) -> Optional[str]:
         """Search for email using Gmail query and return message ID"""
@@ -78,7 +204,8 @@ class EmailProcessor:
             results = self.gmail_service.users().messages().list(
                 userId='me',
                 q=query,
-                maxResults=1
+                maxResults=1,
+                fields=GMAIL_SEARCH_FIELDS
             ).execute()
             
             messages = results.get('messages', [])
@@ -94,7 +221,8 @@ class EmailProcessor:
             message = self.gmail_service.users().messages().get(
                 userId='me',
                 id=msg_id,
-                format='full'
+                format='full',
+                fields=GMAIL_MESSAGE_FIELDS
             ).execute()
             return message
             
@@ -102,7 +230,7 @@ class EmailProcessor:
             self.log(f"Error retrieving email", 'error')
             return {}
     
-    def extract_attachment(self, msg_id: str, message: Dict) -> Optional[str]:
+    def extract_attachment(self, msg_id: str, message: Dict) -> Optional[bytes]:
         """Extract CSV attachment from email"""
         try:
             parts = message.get('payload', {}).get('parts', [])
@@ -119,8 +247,7 @@ class EmailProcessor:
                         ).execute()
                         
                         data = attachment['data']
-                        file_data = base64.urlsafe_b64decode(data)
-                        return file_data.decode('utf-8')
+                        return base64.urlsafe_b64decode(data)
             
             return None
             
@@ -132,30 +259,27 @@ class EmailProcessor:
         """Extract CSV link from email body"""
         try:
             parts = message.get('payload', {}).get('parts', [])
-            body_html = ''
-            body_text = ''
+            html_chunks = []
+            text_chunks = []
             
-            def extract_body(part):
-                nonlocal body_html, body_text
+            # Walk all body content depth-first, keeping the original part order
+            stack = deque(parts)
+            while stack:
+                part = stack.popleft()
                 mime_type = part.get('mimeType', '')
+                data = part.get('body', {}).get('data')
                 
-                if mime_type == 'text/html':
-                    data = part.get('body', {}).get('data', '')
-                    if data:
-                        body_html += base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                elif mime_type == 'text/plain':
-                    data = part.get('body', {}).get('data', '')
-                    if data:
-                        body_text += base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
+                if data:
+                    if mime_type == 'text/html':
+                        html_chunks.append(base64.urlsafe_b64decode(data))
+                    elif mime_type == 'text/plain':
+                        text_chunks.append(base64.urlsafe_b64decode(data))
                 
-                # Recursively check sub-parts
-                if 'parts' in part:
-                    for subpart in part['parts']:
-                        extract_body(subpart)
+                # Check sub-parts next
+                stack.extendleft(reversed(part.get('parts', ())))
             
-            # Extract all body content
-            for part in parts:
-                extract_body(part)
+            body_html = b''.join(html_chunks).decode('utf-8', errors='ignore')
+            body_text = b''.join(text_chunks).decode('utf-8', errors='ignore')
             
             # If no parts, try direct body
             if not body_html and not body_text:
@@ -170,35 +294,31 @@ class EmailProcessor:
             
             # Try HTML first (most reliable for embedded links)
             if body_html:
-                # Extract href attributes from <a> tags
-                href_pattern = r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>'
-                hrefs = re.findall(href_pattern, body_html, re.IGNORECASE)
-                
-                # Look for CSV or S3 links
-                for href in hrefs:
+                # Look for the first <a> tag linking to a CSV or S3 file
+                for match in _HREF_RE.finditer(body_html):
+                    href = match.group(1)
                     if '.csv' in href.lower() or 's3.amazonaws.com' in href.lower():
                         return href
                 
                 # If no CSV-specific links, try general URL extraction from HTML
-                url_pattern = r'https?://[^\s<>"\']+(?:\.csv|s3\.amazonaws\.com[^\s<>"\']*)'
-                urls = re.findall(url_pattern, body_html, re.IGNORECASE)
-                if urls:
-                    return urls[0]
+                match = _HTML_URL_RE.search(body_html)
+                if match:
+                    return match.group(0)
             
             # Try plain text as fallback
             if body_text:
-                csv_links = re.findall(r'https?://[^\s<>"]+\.csv[^\s<>"]*', body_text, re.IGNORECASE)
-                if csv_links:
-                    return csv_links[0]
+                match = _CSV_TEXT_RE.search(body_text)
+                if match:
+                    return match.group(0)
                 
                 # Look for S3 links even without .csv extension
-                s3_links = re.findall(r'https?://[^\s<>"]*s3\.amazonaws\.com[^\s<>"]+', body_text, re.IGNORECASE)
-                if s3_links:
-                    return s3_links[0]
+                match = _S3_TEXT_RE.search(body_text)
+                if match:
+                    return match.group(0)
                 
                 # Generic links as last resort
-                links = re.findall(r'https?://[^\s<>"]+', body_text)
-                for link in links:
+                for match in _ANY_URL_RE.finditer(body_text):
+                    link = match.group(0)
                     if 'csv' in link.lower() or 'export' in link.lower():
                         return link
             
@@ -208,16 +328,24 @@ class EmailProcessor:
             self.log(f"Link extraction error", 'error')
             return None
     
-    def download_csv(self, url: str) -> Optional[str]:
-        """Download CSV from URL"""
+    def download_csv(self, url: str) -> Optional[Iterator[str]]:
+        """Download CSV from URL, streaming its lines as they arrive"""
         try:
             # Some URLs may require authentication or have expired
             # Try with a timeout and handle various HTTP errors
-            response = requests.get(url, timeout=30, allow_redirects=True)
+            response = self._session.get(url, timeout=30, allow_redirects=True, stream=True)
             response.raise_for_status()
-            return response.text
+            
+            # Fall back to UTF-8 when the server declares an unknown charset
+            try:
+                decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+            except LookupError:
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            
+            return self._iter_response_lines(response, decoder)
             
         except requests.exceptions.HTTPError as e:
+            e.response.close()
             if e.response.status_code == 403:
                 self.log(f"CSV download error: Access forbidden (link may have expired)", 'error')
             elif e.response.status_code == 404:
@@ -229,9 +357,27 @@ class EmailProcessor:
             self.log(f"CSV download error", 'error')
             return None
     
-    def parse_csv_source1(self, csv_content: str) -> List[Dict]:
+    def _iter_response_lines(self, response: requests.Response,
+                             decoder: codecs.IncrementalDecoder) -> Iterator[str]:
+        """Decode a streamed response body into newline-terminated lines"""
+        pending = ''
+        
+        try:
+            for chunk in response.iter_content(chunk_size=CSV_CHUNK_SIZE):
+                pending += decoder.decode(chunk)
+                *lines, pending = pending.split('\n')
+                for line in lines:
+                    yield line + '\n'
+            
+            pending += decoder.decode(b'', final=True)
+            if pending:
+                yield pending
+        finally:
+            response.close()
+    
+    def parse_csv_source1(self, csv_lines: Iterable[str]) -> List[Dict]:
         """Parse first CSV source and extract relevant fields"""
-        reader = csv.DictReader(io.StringIO(csv_content))
+        reader = csv.reader(csv_lines)
         entries = []
         
         # Get field mappings from environment
@@ -240,24 +386,42 @@ class EmailProcessor:
         id_field = os.environ.get('CSV1_ID_FIELD')
         date_field = os.environ.get('CSV1_DATE_FIELD')
         
+        # Resolve column positions once (last duplicate header wins, as with DictReader)
+        header = next(reader, None) or []
+        columns = {name: i for i, name in enumerate(header)}
+        id_i = columns.get(id_field)
+        date_i = columns.get(date_field)
+        amount_i = columns.get(amount_field)
+        
+        # Without ID or date columns every row would be skipped
+        if id_i is None or date_i is None:
+            return entries
+        
+        # Exports repeat the same dates across many rows, so parse each once
+        parsed_dates = {}
+        
         for row in reader:
             try:
-                order_id = row.get(id_field, '').strip()
-                date_str = row.get(date_field, '').strip()
+                order_id = row[id_i].strip()
+                date_str = row[date_i].strip()
                 
                 # Skip rows with empty order ID or date (likely total/summary rows)
                 if not order_id or not date_str:
                     continue
                 
                 # Skip rows where order_id is not a number (like "Total", "Summary", etc)
-                if not order_id.replace('.', '', 1).isdigit():
+                if not _ORDER_ID_RE.match(order_id):
                     continue
                 
+                order_date = parsed_dates.get(date_str)
+                if order_date is None:
+                    order_date = parsed_dates[date_str] = self._parse_date(date_str)
+                
                 entry = {
                     'source': source_name,
-                    'order_amount': float(row.get(amount_field, 0)),
+                    'order_amount': float(row[amount_i]) if amount_i is not None else 0.0,
                     'order_id': order_id,
-                    'order_date': self._parse_date(date_str)
+                    'order_date': order_date
                 }
                 entries.append(entry)
                 
@@ -266,16 +430,17 @@ class EmailProcessor:
         
         return entries
     
-    def parse_csv_source2(self, csv_content: str) -> List[Dict]:
+    def parse_csv_source2(self, csv_content: bytes) -> List[Dict]:
         """Parse second CSV source (skip first row) and extract relevant fields"""
-        lines = csv_content.strip().split('\n')
+        # Decode lazily while reading rather than materializing a second copy as str
+        buf = io.TextIOWrapper(io.BytesIO(csv_content.lstrip()), encoding='utf-8', newline='')
         
         # Skip first row if configured
         skip_rows = int(os.environ.get('CSV2_SKIP_ROWS', 0))
-        if skip_rows > 0 and len(lines) > skip_rows:
-            lines = lines[skip_rows:]
+        for _ in range(skip_rows):
+            buf.readline()
         
-        reader = csv.DictReader(io.StringIO('\n'.join(lines)))
+        reader = csv.reader(buf)
         entries = []
         current_year = datetime.now().year
         
@@ -285,25 +450,41 @@ class EmailProcessor:
         id_field = os.environ.get('CSV2_ID_FIELD')
         date_field = os.environ.get('CSV2_DATE_FIELD')
         
+        # Resolve column positions once (last duplicate header wins, as with DictReader)
+        header = next(reader, None) or []
+        columns = {name: i for i, name in enumerate(header)}
+        id_i = columns.get(id_field)
+        date_i = columns.get(date_field)
+        amount_i = columns.get(amount_field)
+        
+        # Without ID or date columns every row would be skipped
+        if id_i is None or date_i is None:
+            return entries
+        
+        # Exports repeat the same dates across many rows, so parse each once
+        parsed_dates = {}
+        
         for row in reader:
             try:
-                date_str = row.get(date_field, '').strip()
-                order_id = row.get(id_field, '').strip()
+                date_str = row[date_i].strip()
+                order_id = row[id_i].strip()
                 
                 # Skip rows with empty order ID or date (likely total/summary rows)
                 if not order_id or not date_str:
                     continue
                 
                 # Skip rows where order_id is not a number (like "Total", "Summary", etc)
-                if not order_id.replace('.', '', 1).isdigit():
+                if not _ORDER_ID_RE.match(order_id):
                     continue
                 
                 # Additional check: Skip rows where the first column contains "Total" or "Summary" (case-insensitive)
-                first_col_value = list(row.values())[0].strip().lower() if row.values() else ''
+                first_col_value = row[0].strip().lower()
                 if first_col_value in ['total', 'summary', 'subtotal', 'grand total']:
                     continue
                 
-                order_date = self._parse_date_with_year(date_str, current_year)
+                order_date = parsed_dates.get(date_str)
+                if order_date is None:
+                    order_date = parsed_dates[date_str] = self._parse_date_with_year(date_str, current_year)
                 
                 # Skip if date parsing returned empty or invalid date
                 if not order_date or order_date.strip() == '':
@@ -311,7 +492,7 @@ class EmailProcessor:
                 
                 entry = {
                     'source': source_name,
-                    'order_amount': float(row.get(amount_field, 0)),
+                    'order_amount': float(row[amount_i]) if amount_i is not None else 0.0,
                     'order_id': order_id,
                     'order_date': order_date
                 }
@@ -329,19 +510,40 @@ class EmailProcessor:
             return datetime.now().strftime('%Y-%m-%d')
             
         try:
-            formats = [
-                '%Y-%m-%d',
-                '%m/%d/%Y',
-                '%d/%m/%Y',
-                '%Y-%m-%d %H:%M:%S',
-                '%m/%d/%Y %H:%M:%S',
-                '%d-%m-%Y',
-                '%Y/%m/%d',
-            ]
+            date_str = date_str.strip()
+            match = _DATE_RE.fullmatch(date_str)
             
-            for fmt in formats:
+            if match:
+                has_time = match['hour'] is not None
+                valid_time = not has_time or (
+                    int(match['hour']) < 24 and int(match['minute']) < 60 and int(match['second']) < 60
+                )
+                
+                # Candidate (year, month, day) orders, mirroring _DATE_FORMATS
+                if match['y1']:
+                    # %Y-%m-%d (optionally with time) or %Y/%m/%d
+                    candidates = [(match['y1'], match['m1'], match['d1'])]
+                    if has_time and match['sep1'] == '/':
+                        candidates = []
+                elif match['sep2'] == '/':
+                    # %m/%d/%Y (optionally with time), then %d/%m/%Y
+                    candidates = [(match['y2'], match['a'], match['b'])]
+                    if not has_time:
+                        candidates.append((match['y2'], match['b'], match['a']))
+                else:
+                    # %d-%m-%Y
+                    candidates = [] if has_time else [(match['y2'], match['b'], match['a'])]
+                
+                if valid_time:
+                    for year, month, day in candidates:
+                        try:
+                            return date(int(year), int(month), int(day)).isoformat()
+                        except ValueError:
+                            continue
+            
+            for fmt in _DATE_FORMATS:
                 try:
-                    dt = datetime.strptime(date_str.strip(), fmt)
+                    dt = datetime.strptime(date_str, fmt)
                     return dt.strftime('%Y-%m-%d')
                 except ValueError:
                     continue
@@ -355,14 +557,7 @@ class EmailProcessor:
     def _parse_date_with_year(self, date_str: str, year: int) -> str:
         """Parse date string without year and add current year"""
         try:
-            formats = [
-                '%m/%d',
-                '%d/%m',
-                '%b %d',
-                '%B %d',
-            ]
-            
-            for fmt in formats:
+            for fmt in _DATE_NO_YEAR_FORMATS:
                 try:
                     dt = datetime.strptime(date_str, fmt)
                     dt = dt.replace(year=year)
@@ -376,100 +571,209 @@ class EmailProcessor:
         except Exception:
             return f"{year}-01-01"
     
-    def check_notion_entry_exists(self, order_id: str) -> Optional[str]:
-        """Check if order already exists in Notion, return page ID if found"""
-        try:
-            response = self.notion.databases.query(
-                database_id=self.database_id,
-                filter={
-                    "property": "Order ID",
-                    "number": {
-                        "equals": int(order_id) if order_id.isdigit() else 0
-                    }
-                }
-            )
-            
-            results = response.get('results', [])
-            return results[0]['id'] if results else None
-            
-        except Exception as e:
-            return None
+    def _notion_order_id(self, order_id: str) -> int:
+        """Map a CSV order ID to the number stored in the Notion ID property"""
+        return int(order_id) if order_id.isdigit() else 0
     
-    def create_or_update_notion_entry(self, entry: Dict):
-        """Create or update entry in Notion database"""
-        try:
-            # Skip entries with empty order_id
-            if not entry.get('order_id') or str(entry['order_id']).strip() == '':
-                return
+    def _load_existing_notion_pages(self, order_ids: Set[int]) -> Dict[int, Tuple]:
+        """Fetch existing Notion pages for the given order IDs, return {order_id: (page_id, *values)}"""
+        id_property = self.notion_props['id']
+        existing = {}
+        ids = sorted(order_ids)
+        
+        # Notion caps compound filters at 100 conditions
+        for i in range(0, len(ids), 100):
+            query_filter = {
+                "or": [
+                    {"property": id_property, "number": {"equals": oid}}
+                    for oid in ids[i:i + 100]
+                ]
+            }
+            start_cursor = None
             
-            # Check if entry exists
-            existing_page_id = self.check_notion_entry_exists(entry['order_id'])
-            
-            # Get additional property names from environment
-            source_property = os.environ.get('NOTION_SOURCE_PROPERTY', 'Source')
-            amount_property = os.environ.get('NOTION_AMOUNT_PROPERTY', 'Order Amount')
-            id_property = os.environ.get('NOTION_ID_PROPERTY', 'Order ID')
-            date_property = os.environ.get('NOTION_DATE_PROPERTY', 'Order Date')
-            checkbox_property = os.environ.get('NOTION_CHECKBOX_PROPERTY', 'Sum-er')
-            
-            properties = {
-                source_property: {
-                    "title": [{"text": {"content": entry['source']}}]
-                },
-                amount_property: {
-                    "number": entry['order_amount']
-                },
-                id_property: {
-                    "number": int(entry['order_id']) if entry['order_id'].isdigit() else 0
-                },
-                date_property: {
-                    "date": {
-                        "start": entry['order_date'] if entry['order_date'] and entry['order_date'].strip() else datetime.now().strftime('%Y-%m-%d'),
-                        "end": None,
-                        "time_zone": None
-                    }
-                },
-                checkbox_property: {
-                    "checkbox": True
+            try:
+                while True:
+                    kwargs = {'database_id': self.database_id, 'filter': query_filter, 'page_size': 100}
+                    if start_cursor:
+                        kwargs['start_cursor'] = start_cursor
+                    
+                    response = self.notion.databases.query(**kwargs)
+                    
+                    for page in response.get('results', []):
+                        properties = page.get('properties', {})
+                        oid = properties.get(id_property, {}).get('number')
+                        if oid is not None:
+                            existing.setdefault(int(oid), (page['id'],) + self._page_values(properties))
+                    
+                    if not response.get('has_more'):
+                        break
+                    start_cursor = response.get('next_cursor')
+                    
+            except Exception as e:
+                self.log(f"Notion query error", 'error')
+        
+        return existing
+    
+    def _page_values(self, properties: Dict) -> Tuple:
+        """Extract (amount, date, source, checkbox) from Notion page properties"""
+        title = properties.get(self.notion_props['source'], {}).get('title') or []
+        date_value = properties.get(self.notion_props['date'], {}).get('date') or {}
+        return (
+            properties.get(self.notion_props['amount'], {}).get('number'),
+            date_value.get('start'),
+            ''.join(part.get('plain_text', '') for part in title),
+            properties.get(self.notion_props['check'], {}).get('checkbox'),
+        )
+    
+    def _entry_values(self, properties: Dict) -> Tuple:
+        """Extract (amount, date, source, checkbox) from properties built for an entry"""
+        return (
+            properties[self.notion_props['amount']]['number'],
+            properties[self.notion_props['date']]['date']['start'],
+            ''.join(part['text']['content'] for part in properties[self.notion_props['source']]['title']),
+            properties[self.notion_props['check']]['checkbox'],
+        )
+    
+    def _build_notion_properties(self, entry: Dict, order_id: int) -> Dict:
+        """Build Notion page properties for an entry with its Notion order ID"""
+        return {
+            self.notion_props['source']: {
+                "title": [{"text": {"content": entry['source']}}]
+            },
+            self.notion_props['amount']: {
+                "number": entry['order_amount']
+            },
+            self.notion_props['id']: {
+                "number": order_id
+            },
+            self.notion_props['date']: {
+                "date": {
+                    "start": entry['order_date'] if entry['order_date'] and entry['order_date'].strip() else datetime.now().strftime('%Y-%m-%d'),
+                    "end": None,
+                    "time_zone": None
                 }
+            },
+            self.notion_props['check']: {
+                "checkbox": True
             }
-            
-            if existing_page_id:
-                self.notion.pages.update(
-                    page_id=existing_page_id,
-                    properties=properties
-                )
+        }
+    
+    async def _wait_for_notion_slot(self, delay: float = 0.0):
+        """Wait until the next Notion request may start, optionally pushing it back by delay"""
+        loop = asyncio.get_running_loop()
+        
+        async with self._notion_pace_lock:
+            self._notion_next_start = max(self._notion_next_start, loop.time() + delay)
+            wait = self._notion_next_start - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._notion_next_start = loop.time() + NOTION_REQUEST_INTERVAL
+    
+    async def _upsert_entry(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                            entry: Dict, order_id: int, existing: Optional[Tuple]) -> bool:
+        """Create or update a single entry in Notion database, return True on success"""
+        try:
+            properties = self._build_notion_properties(entry, order_id)
+            body = {'properties': properties}
+            
+            if existing:
+                # Skip the update when the page already holds these values
+                if existing[1:] == self._entry_values(properties):
+                    return True
+                method, url = 'PATCH', f"/pages/{existing[0]}"
             else:
-                self.notion.pages.create(
-                    parent={"database_id": self.database_id},
-                    properties=properties
-                )
-                
+                method, url = 'POST', '/pages'
+                body['parent'] = {'database_id': self.database_id}
+            
+            payload = orjson.dumps(body)
+            
+            async with semaphore:
+                retry_after = 0.0
+                for attempt in range(NOTION_MAX_RETRIES):
+                    await self._wait_for_notion_slot(retry_after)
+                    response = await client.request(method, url, content=payload)
+                    
+                    # Back off all requests when Notion rate limits the integration
+                    if response.status_code == 429 and attempt < NOTION_MAX_RETRIES - 1:
+                        retry_after = float(response.headers.get('Retry-After', 1))
+                        continue
+                    break
+            
+            response.raise_for_status()
+            return True
+            
         except Exception as e:
             self.log(f"Notion error", 'error')
+            return False
     
-    def archive_or_delete_email(self, msg_id: str):
-        """Archive email from Gmail inbox (or trash as fallback)"""
-        try:
-            # Try to archive (remove from inbox) - requires gmail.modify scope
-            self.gmail_service.users().messages().modify(
-                userId='me',
-                id=msg_id,
-                body={'removeLabelIds': ['INBOX']}
-            ).execute()
-            
-        except HttpError as error:
+    async def _upsert_async(self, entries: List[Dict], existing_map: Dict[int, Tuple]) -> int:
+        """Create or update entries in Notion database concurrently, return number synced"""
+        # Concurrent creates for the same order would race, so only the last
+        # entry per order ID is written (same end state as a sequential loop)
+        latest = {}
+        for entry in entries:
+            # Skip entries with empty order_id
+            if not entry.get('order_id') or str(entry['order_id']).strip() == '':
+                continue
+            latest[self._notion_order_id(entry['order_id'])] = entry
+        
+        semaphore = asyncio.Semaphore(NOTION_CONCURRENCY)
+        self._notion_pace_lock = asyncio.Lock()
+        self._notion_next_start = 0.0
+        headers = {
+            'Authorization': f"Bearer {os.environ['NOTION_API_KEY']}",
+            'Notion-Version': NOTION_API_VERSION,
+            'Content-Type': 'application/json',
+        }
+        
+        async with httpx.AsyncClient(http2=True, base_url=NOTION_API_URL,
+                                     headers=headers, timeout=30) as client:
+            results = await asyncio.gather(
+                *(self._upsert_entry(client, semaphore, entry, order_id, existing_map.get(order_id))
+                  for order_id, entry in latest.items()),
+                return_exceptions=True
+            )
+        
+        return sum(1 for result in results if result is True)
+    
+    def archive_or_delete_emails(self, msg_ids: List[str]):
+        """Archive emails from Gmail inbox in a single batch request (or trash as fallback)"""
+        forbidden = []
+        
+        def callback(request_id, response, exception):
+            if exception is None:
+                return
             # If archive fails, try moving to trash
-            if error.resp.status == 403:
-                try:
-                    self.gmail_service.users().messages().trash(
-                        userId='me',
-                        id=msg_id
-                    ).execute()
-                except HttpError as trash_error:
-                    self.log(f"Cannot archive or trash email", 'error')
+            if isinstance(exception, HttpError) and exception.resp.status == 403:
+                forbidden.append(request_id)
             else:
                 self.log(f"Email archiving error", 'error')
+        
+        # Try to archive (remove from inbox) - requires gmail.modify scope
+        batch = self.gmail_service.new_batch_http_request(callback=callback)
+        for msg_id in dict.fromkeys(msg_ids):
+            batch.add(
+                self.gmail_service.users().messages().modify(
+                    userId='me',
+                    id=msg_id,
+                    body={'removeLabelIds': ['INBOX']}
+                ),
+                request_id=msg_id
+            )
+        
+        try:
+            batch.execute()
+        except HttpError as error:
+            self.log(f"Email archiving error", 'error')
+        
+        for msg_id in forbidden:
+            try:
+                self.gmail_service.users().messages().trash(
+                    userId='me',
+                    id=msg_id
+                ).execute()
+            except HttpError as trash_error:
+                self.log(f"Cannot archive or trash email", 'error')
     
     def send_alert_email(self, missing_reports: List[str]):
         """Send alert email for missing reports"""
@@ -500,87 +804,129 @@ class EmailProcessor:
         except Exception as error:
             self.log(f"Alert email error", 'error')
     
-    def process(self):
+    def _process_source1(self, source_name: str) -> Tuple[Optional[List[Dict]], Optional[str]]:
+        """Fetch and parse first email (CSV link in body), return entries and message ID"""
+        self.log(f"\nProcessing {source_name}")
+        msg_id = self.search_email(self.email1_query)
+        
+        if not msg_id:
+            self.log(f"{source_name}: Email not found", 'error')
+            return None, None
+        
+        self.log(f"{source_name}: Email found")
+        
+        message = self.get_email_details(msg_id)
+        csv_link = self.extract_csv_link(message)
+        
+        if not csv_link:
+            self.log(f"{source_name}: CSV link not found", 'error')
+            return None, msg_id
+        
+        self.log(f"{source_name}: CSV link found")
+        csv_lines = self.download_csv(csv_link)
+        entries = None
+        
+        if csv_lines:
+            # The body is read while parsing, so transfer errors surface here
+            try:
+                entries = self.parse_csv_source1(csv_lines)
+            except requests.exceptions.RequestException as error:
+                self.log(f"CSV download error", 'error')
+        
+        if entries is None:
+            self.log(f"{source_name}: CSV download failed", 'error')
+            return None, msg_id
+        
+        # Overlapping exports repeat orders; only the last row per order matters
+        entries = list({entry['order_id']: entry for entry in entries}.values())
+        
+        self.log(f"{source_name}: Parsed {len(entries)} entries")
+        return entries, msg_id
+    
+    def _process_source2(self, source_name: str) -> Tuple[Optional[List[Dict]], Optional[str]]:
+        """Fetch and parse second email (CSV attachment), return entries and message ID"""
+        self.log(f"\nProcessing {source_name}")
+        msg_id = self.search_email(self.email2_query)
+        
+        if not msg_id:
+            self.log(f"{source_name}: Email not found", 'error')
+            return None, None
+        
+        self.log(f"{source_name}: Email found")
+        
+        message = self.get_email_details(msg_id)
+        csv_content = self.extract_attachment(msg_id, message)
+        
+        if not csv_content:
+            self.log(f"{source_name}: CSV attachment not found", 'error')
+            return None, msg_id
+        
+        self.log(f"{source_name}: CSV attachment extracted")
+        
+        # The attachment is decoded while parsing, so invalid UTF-8 surfaces here
+        try:
+            entries = self.parse_csv_source2(csv_content)
+        except UnicodeDecodeError as error:
+            self.log(f"Attachment extraction error", 'error')
+            self.log(f"{source_name}: CSV attachment not found", 'error')
+            return None, msg_id
+        
+        # Overlapping exports repeat orders; only the last row per order matters
+        entries = list({entry['order_id']: entry for entry in entries}.values())
+        
+        self.log(f"{source_name}: Parsed {len(entries)} entries")
+        return entries, msg_id
+    
+    async def process(self):
         """Main processing logic"""
         self.log("Starting processing", 'summary')
         
         missing_reports = []
         processed_emails = []
+        all_entries = []
         entries_created = 0
         
         # Get source names for reporting
         source1_name = os.environ.get('CSV1_SOURCE_NAME', 'Source1')
         source2_name = os.environ.get('CSV2_SOURCE_NAME', 'Source2')
         
-        # Process first email (CSV link in body)
-        self.log(f"\nProcessing {source1_name}")
-        email1_id = self.search_email(self.email1_query)
+        # Fetch and parse both sources concurrently
+        async with asyncio.TaskGroup() as tg:
+            task1 = tg.create_task(asyncio.to_thread(self._process_source1, source1_name))
+            task2 = tg.create_task(asyncio.to_thread(self._process_source2, source2_name))
         
-        if email1_id:
-            self.log(f"Email found")
-            
-            message = self.get_email_details(email1_id)
-            csv_link = self.extract_csv_link(message)
-            
-            if csv_link:
-                self.log(f"CSV link found")
-                csv_content = self.download_csv(csv_link)
-                
-                if csv_content:
-                    entries = self.parse_csv_source1(csv_content)
-                    self.log(f"Parsed {len(entries)} entries")
-                    
-                    for entry in entries:
-                        self.create_or_update_notion_entry(entry)
-                        entries_created += 1
-                    
-                    processed_emails.append((source1_name, email1_id))
-                else:
-                    self.log("CSV download failed", 'error')
-                    missing_reports.append(source1_name)
+        for source_name, (entries, msg_id) in ((source1_name, task1.result()),
+                                                (source2_name, task2.result())):
+            if entries is None:
+                missing_reports.append(source_name)
             else:
-                self.log("CSV link not found", 'error')
-                missing_reports.append(source1_name)
-        else:
-            self.log("Email not found", 'error')
-            missing_reports.append(source1_name)
-        
-        # Process second email (CSV attachment)
-        self.log(f"\nProcessing {source2_name}")
-        email2_id = self.search_email(self.email2_query)
+                all_entries.extend(entries)
+                processed_emails.append((source_name, msg_id))
         
-        if email2_id:
-            self.log(f"Email found")
-            
-            message = self.get_email_details(email2_id)
-            csv_content = self.extract_attachment(email2_id, message)
+        # Sync entries from both sources, looking up existing pages in bulk
+        if all_entries:
+            self.log("\nSyncing to Notion")
+            existing_map = await asyncio.to_thread(
+                self._load_existing_notion_pages,
+                {self._notion_order_id(entry['order_id']) for entry in all_entries}
+            )
             
-            if csv_content:
-                self.log("CSV attachment extracted")
-                entries = self.parse_csv_source2(csv_content)
-                self.log(f"Parsed {len(entries)} entries")
-                
-                for entry in entries:
-                    self.create_or_update_notion_entry(entry)
-                    entries_created += 1
-                
-                processed_emails.append((source2_name, email2_id))
-            else:
-                self.log("CSV attachment not found", 'error')
-                missing_reports.append(source2_name)
-        else:
-            self.log("Email not found", 'error')
-            missing_reports.append(source2_name)
+            entries_created = await self._upsert_async(all_entries, existing_map)
         
-        # Cleanup
+        # Cleanup and alert run side by side
         self.log("\nCleanup")
-        for source, msg_id in processed_emails:
-            self.archive_or_delete_email(msg_id)
+        pending = []
+        if processed_emails:
+            pending.append(asyncio.to_thread(
+                self.archive_or_delete_emails, [msg_id for source, msg_id in processed_emails]
+            ))
         
         # Send alert if needed
         if missing_reports:
             self.log(f"\nMissing reports: {', '.join(missing_reports)}", 'error')
-            self.send_alert_email(missing_reports)
+            pending.append(asyncio.to_thread(self.send_alert_email, missing_reports))
+        
+        await asyncio.gather(*pending)
         
         self.log("\nProcessing complete", 'summary')
         self.log(f"Processed: {len(processed_emails)} emails", 'summary')
@@ -591,7 +937,7 @@ class EmailProcessor:
 if __name__ == "__main__":
     try:
         processor = EmailProcessor()
-        processor.process()
+        asyncio.run(processor.process())
         
     except Exception as e:
         print(f"Fatal error occurred")